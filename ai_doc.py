@@ -1,18 +1,57 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import google.generativeai as genai
 import folium
+from folium.plugins import MarkerCluster
 import requests
-import json
-from streamlit_folium import folium_static
+from requests.adapters import HTTPAdapter
+import orjson
+import sqlite3
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import numpy as np
+import pandas as pd
+
+# Number of most recent user/AI turns always included in the prompt
+CONTEXT_WINDOW_TURNS = 6
+# Number of older turns recalled by similarity to the new message (0 disables)
+RETRIEVED_TURNS = 3
+EMBEDDING_MODEL = "models/text-embedding-004"
+# SQLite file used to keep conversation history across page refreshes
+HISTORY_DB_PATH = "medibot_history.db"
+
+OVERPASS_TIMEOUT = 10
+# Hospital searches and maps are cached for this long, keeping at most this many maps
+HOSPITAL_CACHE_TTL = 3600
+MAP_CACHE_SIZE = 32
+# Decimal places kept in coordinates (~100m) so small input jitter still hits caches
+LOCATION_PRECISION = 3
+# Hospital popup markup and the marker count above which pins are clustered
+POPUP_FMT = "<b>{name}</b><br>Phone: {phone}<br>Address: {address}"
+CLUSTER_THRESHOLD = 50
+# Completed Gemini responses are reused for identical prompts within this window,
+# keeping at most this many
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_SIZE = 256
+
+# Shared HTTP session so repeat Overpass queries reuse the TLS connection.
+# Cached as a resource because Streamlit re-executes this script on every rerun.
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = "gzip"
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+    return session
 
 # Configure API key
 def configure_genai(api_key):
     genai.configure(api_key=api_key)
 
-# Generate response using Gemini API
-def get_ai_response(user_input, conversation_history, model):
-    # Create prompt with medical context
-    full_prompt = f"""
+# Static parts of the medical prompt, built once so each call only joins in the inputs
+_PROMPT_PREFIX = """
     You are an AI medical assistant. You can provide general medical information and suggestions, 
     but you should always clarify that you're not a licensed medical professional and your advice 
     should not replace professional medical consultation.
@@ -22,20 +61,93 @@ def get_ai_response(user_input, conversation_history, model):
     2. Recommended next steps
     3. When they should seek immediate medical attention
     
-    User's symptoms: {user_input}
+    User's symptoms: """
+_PROMPT_MID = """
     
     Previous conversation for context:
-    {conversation_history}
     """
+_PROMPT_SUFFIX = """
+    """
+
+# Completed responses keyed by a hash of model name and prompt, shared across sessions
+@st.cache_resource
+def get_response_cache():
+    return {}, threading.Lock()
+
+# Stream response chunks from Gemini API
+def get_ai_response(user_input, conversation_history, model):
+    # Create prompt with medical context
+    full_prompt = "".join((_PROMPT_PREFIX, user_input, _PROMPT_MID, conversation_history, _PROMPT_SUFFIX))
+    
+    # Replay a completed response for an identical prompt instead of calling Gemini again
+    cache, lock = get_response_cache()
+    cache_key = hashlib.sha256(f"{model.model_name}\n{full_prompt}".encode()).hexdigest()
+    with lock:
+        cached = cache.get(cache_key)
+    if cached and time.time() - cached[0] < RESPONSE_CACHE_TTL:
+        yield cached[1]
+        return
     
     try:
-        response = model.generate_content(full_prompt)
-        return response.text
+        chunks = []
+        for chunk in model.generate_content(full_prompt, stream=True):
+            chunks.append(chunk.text)
+            yield chunk.text
+        
+        # Buffer the streamed text so a repeat of this prompt is served from memory
+        with lock:
+            cache.pop(cache_key, None)
+            cache[cache_key] = (time.time(), "".join(chunks))
+            while len(cache) > RESPONSE_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
     except Exception as e:
-        return f"Error generating response: {str(e)}"
+        yield f"Error generating response: {str(e)}"
 
-# Get nearby hospitals using OpenStreetMap API
-def get_nearby_hospitals(latitude, longitude, radius=5000):
+# Speaker labels used when serializing conversation history into the prompt
+_ROLE_PREFIX = {"user": "User: ", "ai": "AI: "}
+
+# Embed text for similarity search, returns None if embedding fails
+def embed_text(text):
+    try:
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=text)
+        return np.asarray(result["embedding"], dtype=np.float32)
+    except Exception:
+        return None
+
+# Build prompt context from the recent window plus the most relevant older turns.
+# message_embeddings maps the index of a user message in history to its embedding.
+def build_conversation_context(history, query_embedding=None, message_embeddings=None):
+    window = 2 * CONTEXT_WINDOW_TURNS
+    recent = history[-window:]
+    older_count = max(len(history) - window, 0)
+    
+    recalled = []
+    if older_count and query_embedding is not None and message_embeddings and RETRIEVED_TURNS > 0:
+        # Older user messages are matched by embedding and recalled with the reply after them
+        candidates = [
+            (index, emb) for index, emb in message_embeddings.items()
+            if index < older_count and emb.shape == query_embedding.shape
+        ]
+        if candidates:
+            matrix = np.stack([emb for _, emb in candidates])
+            norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_embedding)
+            scores = matrix @ query_embedding / np.maximum(norms, 1e-8)
+            best = np.argsort(scores)[::-1][:RETRIEVED_TURNS]
+            for index in sorted(candidates[i][0] for i in best):
+                recalled.append(history[index])
+                if index + 1 < older_count and history[index + 1][0] == "ai":
+                    recalled.append(history[index + 1])
+    
+    return "\n".join(_ROLE_PREFIX[role] + msg for role, msg in chain(recalled, recent))
+
+# Round a coordinate pair to the precision used for hospital cache keys
+def round_location(latitude, longitude):
+    return round(latitude, LOCATION_PRECISION), round(longitude, LOCATION_PRECISION)
+
+# Query OpenStreetMap for hospitals, cached so repeat searches skip the network.
+# Errors are raised rather than returned so failed lookups are not cached.
+@st.cache_data(ttl=HOSPITAL_CACHE_TTL, show_spinner=False)
+def fetch_hospitals(latitude, longitude, radius):
     overpass_url = "https://overpass-api.de/api/interpreter"
     overpass_query = f"""
     [out:json];
@@ -43,34 +155,164 @@ def get_nearby_hospitals(latitude, longitude, radius=5000):
     out body;
     """
     
+    response = get_http_session().post(overpass_url, data=overpass_query, timeout=OVERPASS_TIMEOUT)
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    
+    return [
+        {
+            "name": element["tags"]["name"],
+            "phone": element["tags"].get("phone", "N/A"),
+            "lat": element["lat"],
+            "lon": element["lon"],
+            "address": element["tags"].get("addr:full", "Address not available")
+        }
+        for element in data.get("elements", ())
+        if "tags" in element and "name" in element["tags"]
+    ]
+
+# Get nearby hospitals using OpenStreetMap API, returns (hospitals, error)
+def get_nearby_hospitals(latitude, longitude, radius=5000):
     try:
-        response = requests.post(overpass_url, data=overpass_query)
-        data = response.json()
-        hospitals = []
-        
-        for element in data.get("elements", []):
-            if "tags" in element and "name" in element["tags"]:
-                hospitals.append({
-                    "name": element["tags"].get("name", "Unnamed Hospital"),
-                    "phone": element["tags"].get("phone", "N/A"),
-                    "lat": element["lat"],
-                    "lon": element["lon"],
-                    "address": element["tags"].get("addr:full", "Address not available")
-                })
-        
-        return hospitals
+        return fetch_hospitals(*round_location(latitude, longitude), radius), None
     except Exception as e:
-        st.error(f"Error fetching hospital data: {str(e)}")
-        return []
+        return [], f"Error fetching hospital data: {str(e)}"
+
+# Open the history database once per process and create the schema on first use.
+# The lock serializes access because Streamlit sessions run on separate threads.
+@st.cache_resource
+def get_history_db(path=HISTORY_DB_PATH):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS messages (user_id TEXT, role TEXT, msg TEXT, ts REAL, embedding BLOB)"
+    )
+    # Databases created before embeddings were stored lack the column
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+    if "embedding" not in columns:
+        conn.execute("ALTER TABLE messages ADD COLUMN embedding BLOB")
+    conn.execute("CREATE INDEX IF NOT EXISTS messages_user_ts ON messages (user_id, ts)")
+    return conn, threading.Lock()
 
-# Function to get available models
-def list_available_models():
+# Load a user's saved conversation as a list of (role, message) tuples and a dict
+# mapping message index to the stored embedding of that user message
+def load_from_storage(user_id, path=HISTORY_DB_PATH):
     try:
-        models = genai.list_models()
-        model_names = [model.name for model in models]
-        return model_names
-    except Exception as e:
-        return [f"Error listing models: {str(e)}"]
+        conn, lock = get_history_db(path)
+        with lock:
+            rows = conn.execute(
+                "SELECT role, msg, embedding FROM messages WHERE user_id = ? ORDER BY ts, rowid", (user_id,)
+            ).fetchall()
+        conversation = [(role, msg) for role, msg, _ in rows]
+        embeddings = {
+            index: np.frombuffer(blob, dtype=np.float32)
+            for index, (_, _, blob) in enumerate(rows) if blob is not None
+        }
+        return conversation, embeddings
+    except sqlite3.Error as e:
+        st.warning(f"Could not load saved conversation: {str(e)}")
+        return [], {}
+
+# Append (role, message) tuples to a user's saved conversation, with embeddings
+# keyed by position in messages
+def save_to_storage(user_id, messages, embeddings=None, path=HISTORY_DB_PATH):
+    embeddings = embeddings or {}
+    try:
+        conn, lock = get_history_db(path)
+        ts = time.time()
+        rows = []
+        for index, (role, message) in enumerate(messages):
+            embedding = embeddings.get(index)
+            rows.append((user_id, role, message, ts, embedding.tobytes() if embedding is not None else None))
+        with lock, conn:
+            conn.executemany(
+                "INSERT INTO messages (user_id, role, msg, ts, embedding) VALUES (?, ?, ?, ?, ?)", rows
+            )
+    except sqlite3.Error as e:
+        st.warning(f"Could not save conversation: {str(e)}")
+
+# Add a finished user/AI exchange to the session and persist it if a user ID is set.
+# The embedding belongs to the user message and is keyed by its index in the conversation.
+def add_turn(user_id, user_message, ai_message, embedding=None):
+    conversation = st.session_state.conversation
+    if embedding is not None:
+        st.session_state.message_embeddings[len(conversation)] = embedding
+    messages = [("user", user_message), ("ai", ai_message)]
+    conversation.extend(messages)
+    if user_id:
+        save_to_storage(user_id, messages, {0: embedding})
+
+# Return the last hospital search as (hospitals, error) if the query is unchanged
+def get_remembered_hospitals(query_key):
+    if st.session_state.get("hosp_key") == query_key:
+        return st.session_state.hosp_val, None
+    return None
+
+# Remember a successful hospital search so an identical query skips the lookup
+def remember_hospitals(query_key, result):
+    hospitals, error = result
+    if error is None:
+        st.session_state.hosp_key = query_key
+        st.session_state.hosp_val = hospitals
+
+# Function to get available models, fetched once per API key for the process lifetime.
+# Errors propagate so a failed lookup is not cached.
+@st.cache_resource(show_spinner=False)
+def list_available_models(api_key):
+    configure_genai(api_key)
+    return tuple(model.name for model in genai.list_models())
+
+# Build the hospital map and return its rendered HTML, cached per search result
+@st.cache_data(ttl=HOSPITAL_CACHE_TTL, max_entries=MAP_CACHE_SIZE, show_spinner=False)
+def build_map_html(latitude, longitude, hospitals_tuple):
+    m = folium.Map(location=[latitude, longitude], zoom_start=13)
+    folium.Marker([latitude, longitude], tooltip="Your Location").add_to(m)
+    
+    # Add hospital markers to one layer, clustered in the browser for large results
+    if len(hospitals_tuple) > CLUSTER_THRESHOLD:
+        group = MarkerCluster(name="Hospitals")
+    else:
+        group = folium.FeatureGroup(name="Hospitals")
+    for name, phone, lat, lon, address in hospitals_tuple:
+        group.add_child(folium.Marker(
+            [lat, lon],
+            popup=POPUP_FMT.format(name=name, phone=phone, address=address),
+            tooltip=name,
+            icon=folium.Icon(color="red", icon="plus")
+        ))
+    group.add_to(m)
+    
+    return m.get_root().render()
+
+# Render hospital search results as a map and a table
+def show_hospitals(latitude, longitude, hospitals, error):
+    if error:
+        st.error(error)
+    elif hospitals:
+        # Display map, reusing cached HTML for an identical search
+        hospitals_tuple = tuple(
+            (h["name"], h["phone"], h["lat"], h["lon"], h["address"]) for h in hospitals
+        )
+        components.html(build_map_html(latitude, longitude, hospitals_tuple), height=500)
+        
+        # Display hospital list
+        st.subheader("Hospital List")
+        df = pd.DataFrame(hospitals)[["name", "phone", "address"]]
+        df["call"] = ("tel:" + df["phone"]).where(df["phone"] != "N/A")
+        st.dataframe(
+            df,
+            hide_index=True,
+            width="stretch",
+            column_config={
+                "name": "Hospital",
+                "phone": "📞 Phone",
+                "address": "📍 Address",
+                "call": st.column_config.LinkColumn("Call", display_text="Call Hospital")
+            }
+        )
+    else:
+        st.info("No hospitals found in the selected area. Try increasing the radius.")
 
 # Main function
 def main():
@@ -84,6 +326,12 @@ def main():
         st.header("Configuration")
         api_key = st.text_input("Enter your Gemini API Key", type="password")
         
+        # User ID used to save and restore conversation history
+        user_id = st.text_input(
+            "User ID (keeps your history across visits)",
+            value=st.query_params.get("user", "")
+        ).strip()
+        
         # Model selection
         model_name = st.selectbox(
             "Select Gemini Model", 
@@ -105,8 +353,10 @@ def main():
         # Debug section
         if api_key:
             if st.button("List Available Models"):
-                configure_genai(api_key)
-                available_models = list_available_models()
+                try:
+                    available_models = list_available_models(api_key)
+                except Exception as e:
+                    available_models = [f"Error listing models: {str(e)}"]
                 st.write("Available models:")
                 for m in available_models:
                     st.write(f"- {m}")
@@ -114,50 +364,116 @@ def main():
     # Initialize or get conversation history from session state
     if "conversation" not in st.session_state:
         st.session_state.conversation = []
+    if "message_embeddings" not in st.session_state:
+        st.session_state.message_embeddings = {}
     
-    # Display conversation history
-    for i, (role, message) in enumerate(st.session_state.conversation):
-        if role == "user":
-            st.markdown(f"<div style='background-color: #E8F0FE; padding: 10px; border-radius: 10px; margin-bottom: 10px;'><b>You:</b> {message}</div>", unsafe_allow_html=True)
+    # Restore saved history when the user ID is entered or changed
+    previous_user = st.session_state.get("history_user", "")
+    if user_id != previous_user:
+        if not user_id:
+            # ID cleared: stop showing the previous user's history
+            st.session_state.conversation = []
+            st.session_state.message_embeddings = {}
+        elif previous_user:
+            # Switched users: the old conversation is already saved under its own ID
+            st.session_state.conversation, st.session_state.message_embeddings = load_from_storage(user_id)
         else:
-            st.markdown(f"<div style='background-color: #F0F2F5; padding: 10px; border-radius: 10px; margin-bottom: 10px;'><b>AI Doctor:</b> {message}</div>", unsafe_allow_html=True)
+            # ID entered after chatting: keep the unsaved turns after the stored history
+            unsaved = st.session_state.conversation
+            unsaved_embeddings = st.session_state.message_embeddings
+            stored, stored_embeddings = load_from_storage(user_id)
+            if unsaved:
+                save_to_storage(user_id, unsaved, unsaved_embeddings)
+            st.session_state.conversation = stored + unsaved
+            st.session_state.message_embeddings = {
+                **stored_embeddings,
+                **{len(stored) + index: emb for index, emb in unsaved_embeddings.items()}
+            }
+        st.session_state.history_user = user_id
+    
+    # Display conversation history; new turns are written into the same container
+    chat_container = st.container()
+    with chat_container:
+        for role, message in st.session_state.conversation:
+            with st.chat_message("user" if role == "user" else "assistant"):
+                st.markdown(message)
     
-    # Input for new messages
-    user_input = st.text_area("Describe your symptoms:", height=100)
+    # Input for new messages, cleared on submit so a repeated click cannot resend it
+    with st.form("message_form", clear_on_submit=True):
+        user_input = st.text_area("Describe your symptoms:", height=100)
+        find_hospitals = st.checkbox("Also find nearby hospitals")
+        send_clicked = st.form_submit_button("Send")
+    
+    hospital_result = None
+    hospital_key = (*round_location(latitude, longitude), radius)
     
     # Process input when user submits
-    if st.button("Send"):
+    if send_clicked:
         if not api_key:
             st.error("Please enter your Gemini API Key in the sidebar.")
             return
         
         if user_input:
-            # Add user message to conversation
-            st.session_state.conversation.append(("user", user_input))
+            history = st.session_state.conversation
             
-            try:
-                # Configure Gemini API
-                configure_genai(api_key)
-                
-                # Create model with selected name
-                model = genai.GenerativeModel(model_name)
-                
-                # Format conversation history for context
-                conversation_context = "\n".join([f"{'User' if role == 'user' else 'AI'}: {msg}" for role, msg in st.session_state.conversation[:-1]])
+            # Per-Send workers so the Overpass lookup and the message embedding overlap
+            # with the streaming reply without queueing behind other sessions
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                # Look up hospitals in the background while Gemini responds
+                hospital_future = None
+                if find_hospitals and latitude and longitude:
+                    hospital_result = get_remembered_hospitals(hospital_key)
+                    if hospital_result is None:
+                        hospital_future = executor.submit(get_nearby_hospitals, latitude, longitude, radius)
                 
-                # Get AI response
-                response = get_ai_response(user_input, conversation_context, model)
+                try:
+                    # Configure on every Send for global calls such as embed_content, since
+                    # the genai API key is process-global and other sessions may change it
+                    configure_genai(api_key)
+                    
+                    # Reuse the model across reruns unless key or model changed; a model keeps
+                    # the client it first called with, so a new key needs a new model
+                    model_key = (api_key, model_name)
+                    if "model" not in st.session_state or st.session_state.get("model_key") != model_key:
+                        st.session_state.model = genai.GenerativeModel(model_name)
+                        st.session_state.model_key = model_key
+                    model = st.session_state.model
+                    
+                    # Embed the new message in the background so later turns can recall it;
+                    # only wait for it before the reply when there are older turns to recall
+                    embedding_future = None
+                    if RETRIEVED_TURNS > 0:
+                        embedding_future = executor.submit(embed_text, user_input)
+                    query_embedding = None
+                    if embedding_future is not None and len(history) > 2 * CONTEXT_WINDOW_TURNS:
+                        query_embedding = embedding_future.result()
+                    
+                    # Format a bounded slice of conversation history for context
+                    conversation_context = build_conversation_context(
+                        history, query_embedding, st.session_state.message_embeddings
+                    )
+                    
+                    # Append the new turn below the history and stream the AI response into it
+                    with chat_container:
+                        with st.chat_message("user"):
+                            st.markdown(user_input)
+                        with st.chat_message("assistant"):
+                            response = st.write_stream(get_ai_response(user_input, conversation_context, model))
+                    
+                    # Add the exchange to the conversation with the user message's embedding
+                    # so later turns can recall it
+                    embedding = embedding_future.result() if embedding_future is not None else None
+                    add_turn(user_id, user_input, response, embedding)
+                    
+                except Exception as e:
+                    error_message = f"Error: {str(e)}"
+                    add_turn(user_id, user_input, error_message)
+                    st.error(error_message)
                 
-                # Add AI response to conversation
-                st.session_state.conversation.append(("ai", response))
-                
-                # Use st.rerun() instead of experimental_rerun
-                st.rerun()
-                
-            except Exception as e:
-                error_message = f"Error: {str(e)}"
-                st.session_state.conversation.append(("ai", error_message))
-                st.error(error_message)
+                if hospital_future is not None:
+                    with st.spinner("Finding nearby hospitals..."):
+                        hospital_result = hospital_future.result()
+                    remember_hospitals(hospital_key, hospital_result)
     
     # Hospital finder section
     st.markdown("---")
@@ -165,44 +481,15 @@ def main():
     
     if st.button("Find Nearby Hospitals"):
         if latitude and longitude:
-            hospitals = get_nearby_hospitals(latitude, longitude, radius)
-            
-            if hospitals:
-                # Create map
-                m = folium.Map(location=[latitude, longitude], zoom_start=13)
-                folium.Marker([latitude, longitude], tooltip="Your Location").add_to(m)
-                
-                # Add hospital markers
-                for hospital in hospitals:
-                    folium.Marker(
-                        [hospital["lat"], hospital["lon"]],
-                        popup=f"""
-                        <b>{hospital['name']}</b><br>
-                        Phone: {hospital['phone']}<br>
-                        Address: {hospital['address']}
-                        """,
-                        tooltip=hospital["name"],
-                        icon=folium.Icon(color="red", icon="plus")
-                    ).add_to(m)
-                
-                # Display map
-                folium_static(m)
-                
-                # Display hospital list
-                st.subheader("Hospital List")
-                for i, hospital in enumerate(hospitals):
-                    st.markdown(f"""
-                    **{i+1}. {hospital['name']}**  
-                    📞 {hospital['phone']}  
-                    📍 {hospital['address']}  
-                    """)
-                    if hospital["phone"] != "N/A":
-                        st.markdown(f"[Call Hospital](tel:{hospital['phone']})")
-                    st.markdown("---")
-            else:
-                st.info("No hospitals found in the selected area. Try increasing the radius.")
+            hospital_result = get_remembered_hospitals(hospital_key)
+            if hospital_result is None:
+                hospital_result = get_nearby_hospitals(latitude, longitude, radius)
+                remember_hospitals(hospital_key, hospital_result)
+            show_hospitals(latitude, longitude, *hospital_result)
         else:
             st.error("Please enter valid latitude and longitude.")
+    elif hospital_result is not None:
+        show_hospitals(latitude, longitude, *hospital_result)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file